@@ -8,26 +8,53 @@ Translate head-tracking opentrack UDP-output to Linux-evdev/HID mouse events.
 Usage:
 ======
 
-    python3 opentrack-mouse-original.py [-f <float>] -w <float> -a <steps> -t <float> [-z] [-d]
+    python3 opentrack-mouse.py [-h] [-H] [-f <float>] [-w <float>] [-s <int>] [-q <float>] [-a <zone>]
+                               [-t <float>] [-z] [-i <ip-addr>] [-p <port>] [-r <bytes>] [-P <usecs>] [-R] [-c <cpu>] [-d]
 
 Optional Arguments
 ------------------
 
-    -f <float>   Scale factor, alters sensitivity (default 30.0, 10.0 is good for games)
-    -w <float>   Wait seconds for input, then interpolate (default 0.001
+    -f <float>, --scale-factor <float>
+                 Scale factor, alters sensitivity (default 35.0, 10.0 is good for games)
+    -w <float>, --wait-seconds <float>
+                 Wait seconds for input, then interpolate (default 0.001
                  to simulate a 1000 MHz mouse)
-    -s <int>     Smooth over n values (default 100)
-    -q <float>   Smoothing alpha 0.0..1.0, smaller values smooth more (default 0.1)
-    -a <zone>    Auto-center (press middle mouse button) if all tracking
+    -s <int>, --smooth-n <int>
+                 Smoothing is on for n greater than 1 and off for n of 1 or
+                 less, the amount of smoothing is set by alpha (default 100)
+    -q <float>, --smooth-alpha <float>
+                 Smoothing alpha 0.0..1.0, smaller values smooth more (default 0.1)
+    -a <zone>, --auto-center <zone>
+                 Auto-center (press middle mouse button) if all tracking
                  values are in the -zone..+zone (default 0.0, suggest 5.0)
-    -t <float>   Auto-center required seconds for all values remain in
+    -t <float>, --auto-center-seconds <float>
+                 Auto-center required seconds for all values remain in
                  the zone for this many seconds (default 1.0)
-    -z           Translate opentrack z-axis values to mouse wheel
+    -z, --wheel  Translate opentrack z-axis values to mouse wheel
                  events (default is off)
-    -i <ip-addr> The ip-address to listen on for the UDP feed from opentrack
-    -p <port>    The UDP port number to listen on for the UDP feed from opentrack
-    -d           Output mouse event x, y, z values to stdout for
-                 debugging purposes.
+    -i <ip-addr>, --ip-address <ip-addr>
+                 The ip-address to listen on for the UDP feed from opentrack
+    -p <port>, --port <port>
+                 The UDP port number to listen on for the UDP feed from opentrack
+    -r <bytes>, --receive-buffer <bytes>
+                 The UDP socket receive buffer size, a larger buffer avoids dropping
+                 packets during scheduling delays, the kernel limits it to
+                 /proc/sys/net/core/rmem_max (default 1048576)
+    -P <usecs>, --busy-poll <usecs>
+                 Busy-poll the network device for up to usecs when waiting
+                 for a packet (SO_BUSY_POLL), see Realtime Scheduling below
+                 (default 0, off)
+    -R, --realtime
+                 Use realtime scheduling (SCHED_FIFO) for more consistent
+                 timing, see Realtime Scheduling below
+    -c <cpu>, --cpu <cpu>
+                 Pin the process to the given CPU number (default unpinned)
+    -h, --help   help
+    -H, --detailed-help
+                 detailed help (in Markdown format)
+    -d, --debug  Output mouse event x, y, z values to stdout for
+                 debugging purposes (lines that would repeat for every
+                 packet are limited to 20 per second of each kind).
 
 Description
 ===========
@@ -64,12 +91,43 @@ Get the python (python-3) evdev library:
 
 Run this script:
 
-    python3 opentrack-mouse-original.py
+    python3 opentrack-mouse.py
 
 Start opentrack; select Output `UDP over network`; configure the
 output option to IP address 127.0.0.1, port 5005; start tracking;
 move head.
 
+Realtime Scheduling
+===================
+
+The `-R` option requests the `SCHED_FIFO` realtime scheduling policy
+so that packets are handled promptly even when the desktop is busy.
+An unprivileged user needs a realtime-priority limit, for example,
+in `/etc/security/limits.conf`:
+
+    myuser  -  rtprio  20
+
+If the request is refused, a message is printed and opentrack-mouse
+carries on with normal scheduling.
+
+The `-c <cpu>` option pins the process to a single CPU, which
+avoids it being migrated between cores.  Realtime scheduling and
+pinning work best together on a CPU that is otherwise lightly
+loaded, for example, one reserved by the `isolcpus=` kernel
+parameter.
+
+When opentrack runs on another machine, the `-P <usecs>` option
+asks the kernel to busy-poll the network device for up to usecs
+microseconds when waiting for a packet (`SO_BUSY_POLL`), rather than
+waiting for the device's interrupt.  This trades CPU time for lower
+and steadier latency.  It only helps devices with NAPI polling
+support, it has no effect on the loopback device used when opentrack
+runs on the same machine.  Values above `net.core.busy_read` need
+`CAP_NET_ADMIN`, if the request is refused, a message is printed and
+opentrack-mouse carries on without busy-polling.  When busy-polling,
+pin the process with `-c` to a CPU that handles the network device's
+interrupts (see `/proc/irq/*/smp_affinity_list`).
+
 Opentrack Protocol
 ==================
 
@@ -133,8 +191,9 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
-import math
-import select
+import argparse
+import os
+import selectors
 import socket
 import struct
 import sys
@@ -142,9 +201,19 @@ import time
 from pathlib import Path
 
 import evdev
+from evdev.ecodes import EV_REL, REL_X, REL_Y, REL_WHEEL
 
 UDP_IP = "127.0.0.1"
 UDP_PORT = 5005
+UDP_RECEIVE_BUFFER = 1024 * 1024
+REALTIME_PRIORITY = 20
+# Debug lines are printed at most this often, a line per packet at 1 kHz is more than anyone can read.
+DEBUG_PRINT_INTERVAL_NS = 50_000_000
+# Linux socket option, not exported by the socket module.
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)
+
+# Each opentrack UDP-Output packet contains 6 little-endian doubles: x, y, z, yaw, pitch, and roll.
+OPENTRACK_PACKET = struct.Struct('<6d')
 
 
 class OpenTrackMouse:
@@ -165,6 +234,10 @@ class OpenTrackMouse:
         self.centered = True
         self.center_arrival_time_ns = 0
         self.previous_event_time = time.time_ns()
+        self.debug_next_print_time = 0
+        self.debug_next_center_print_time = 0
+        # Pick the send implementation once, rather than testing for debug on every packet.
+        self.__send_to_hid__ = self.__send_to_hid_debug__ if debug else self.__send_to_hid_fast__
         print(f"Scale output by: {scale_factor}\nMaximum output interval: {wait_secs} seconds (then repeat previous values)\n"
               f"Wheel enabled: {enable_wheel}\nDebug: {debug}")
         print(f"Smoothing: n={self.smoothing} alpha={self.smooth_alpha}")
@@ -178,31 +251,53 @@ class OpenTrackMouse:
             },
             name="opentrack_mouse")
 
-    def start(self, udp_ip=UDP_IP, udp_port=UDP_PORT):
-        print(f"UDP IP={udp_ip} PORT={udp_port}")
+    def start(self, udp_ip=UDP_IP, udp_port=UDP_PORT, receive_buffer=UDP_RECEIVE_BUFFER, busy_poll=0):
+        print(f"UDP IP={udp_ip} PORT={udp_port} RCVBUF={receive_buffer}")
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,48)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
         sock.bind((udp_ip, udp_port))
+        if busy_poll > 0:
+            set_busy_poll(sock, busy_poll)
         sock.setblocking(False)
-        self.current = unpacked_data = (0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
-        smoothers = [Smooth(n=self.smoothing, alpha=self.smooth_alpha) for i in range(len(self.current))]
+        # Register once, rather than having select() rebuild its fd sets on every iteration.
+        # A receive timeout (SO_RCVTIMEO) would save the wait call, but the kernel rounds it
+        # up to whole timer ticks (4 ms at CONFIG_HZ=250), far coarser than the 1 ms wait.
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        # Received into the same buffer every time, rather than allocating a new bytes per packet.
+        packet = bytearray(OPENTRACK_PACKET.size)
+        self.current = (0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        smoother = SmoothAxes(n=self.smoothing, alpha=self.smooth_alpha, width=len(self.current))
+        # The loop runs once per packet or wait, so look up everything it uses just the once.
+        wait_secs = self.wait_secs
+        auto_center = self.auto_center > 0.0
+        scale_factor = self.scale_factor
+        z_scale_factor = scale_factor / 3
+        select = selector.select
+        convert_to_mouse_value = self.convert_to_mouse_value
+        # Start the smoother and the previous position from the first packet, rather than from zero,
+        # mouse moves are relative, so start-up then produces no movement of its own.
+        unpacked_data = None
+        while unpacked_data is None:
+            select()
+            unpacked_data = receive_latest(sock, packet)
+        self.previous = self.current = smoother.smooth(unpacked_data)
         while True:
             # Use previous data value if none is ready - keeps the mouse moving smoothly in the current direction
-            if select.select([sock], [], [], self.wait_secs)[0]:
-                data, _ = sock.recvfrom(48)
-                # Unpack 6 little endian doubles into a list:
-                unpacked_data = struct.unpack('<6d', data[0:48])
-                self.current = [smoother.smooth(datum) for datum, smoother in zip(unpacked_data, smoothers)]
-                if self.auto_center > 0.0:
-                    if self.__auto_center__(self.current):
-                        continue  # Don't send the current data, we just centered, moving again might cause a jink
+            if select(wait_secs):
+                unpacked_data = receive_latest(sock, packet)
+                if unpacked_data is not None:
+                    self.current = smoother.smooth(unpacked_data)
+                    if auto_center:
+                        if self.__auto_center__(self.current):
+                            continue  # Don't send the current data, we just centered, moving again might cause a jink
             # using yaw for mouse-x, pitch for mouse-y, z movement for mouse-z
             _, _, z, yaw, pitch, _ = self.previous
             _, _, zn, yaw_new, pitch_new, _ = self.current
             # Note the hacky scale factor for Z, probably needs a better algorithm that also consults pitch
-            self.__send_to_hid__(self.convert_to_mouse_value(yaw_new, yaw, self.scale_factor),
-                                 self.convert_to_mouse_value(pitch, pitch_new, self.scale_factor),
-                                 self.convert_to_mouse_value(z, zn, self.scale_factor / 3))
+            self.__send_to_hid__(convert_to_mouse_value(yaw_new, yaw, scale_factor),
+                                 convert_to_mouse_value(pitch, pitch_new, scale_factor),
+                                 convert_to_mouse_value(z, zn, z_scale_factor))
             self.previous = self.current
 
     def convert_to_mouse_value(self, v1, v2, scale_factor):
@@ -215,7 +310,7 @@ class OpenTrackMouse:
             if not (-self.auto_center < value < self.auto_center):
                 self.centered = False  # Currently off centre
                 self.center_arrival_time_ns = 0
-                print(f"Off center {time.strftime('%H:%M:%S')}") if self.debug else False
+                self.print_debug_throttled(f"Off center {time.strftime('%H:%M:%S')}") if self.debug else False
                 return False
         # If we reach here and have not yet re-centered, we need to see if it's time to do so:
         if not self.centered:
@@ -226,7 +321,8 @@ class OpenTrackMouse:
                 self.center_arrival_time_ns = now_ns
             if (now_ns - self.center_arrival_time_ns) < self.auto_center_ns:
                 # Still at the center, waiting to see if we stay in the center long enough
-                print(f"Time in center: {(now_ns - self.center_arrival_time_ns) / 1_000_000_000} secs") if self.debug else False
+                self.print_debug_throttled(
+                    f"Time in center: {(now_ns - self.center_arrival_time_ns) / 1_000_000_000} secs") if self.debug else False
                 return False
             # If we reach here, we've been sitting in the center long enough - re-center now.
             print(f"Middle click (centering) {time.strftime('%H:%M:%S')}")
@@ -241,90 +337,175 @@ class OpenTrackMouse:
             return True
         return False
 
-    def __send_to_hid__(self, x, y, z):
+    def print_debug_throttled(self, message):
+        # For auto-center debug lines that would otherwise repeat for every packet.  They have a limit
+        # of their own, so they can't use up the slots of the event lines, or be crowded out by them.
+        now = time.time_ns()
+        if now >= self.debug_next_center_print_time:
+            print(message)
+            self.debug_next_center_print_time = now + DEBUG_PRINT_INTERVAL_NS
+
+    def __send_to_hid_fast__(self, x, y, z):
+        # Used when not debugging, nothing here is spent on timing or formatting messages.
+        # The event codes are imported by name, so nothing is looked up in evdev.ecodes here.
+        write = self.hid_device.write
         event_count = 0
         if x != 0:
-            self.hid_device.write(evdev.ecodes.EV_REL, evdev.ecodes.REL_X, x)
+            write(EV_REL, REL_X, x)
             event_count += 1
         if y != 0:
-            self.hid_device.write(evdev.ecodes.EV_REL, evdev.ecodes.REL_Y, y)
+            write(EV_REL, REL_Y, y)
             event_count += 1
         if self.enable_wheel and z != 0:
             # Z is a wheel - treat differently
-            self.hid_device.write(evdev.ecodes.EV_REL, evdev.ecodes.REL_WHEEL, -1 if z < 0 else 1)
+            write(EV_REL, REL_WHEEL, -1 if z < 0 else 1)
             event_count += 1
+        if event_count != 0:
+            self.hid_device.syn()
+        return event_count
+
+    def __send_to_hid_debug__(self, x, y, z):
+        event_count = self.__send_to_hid_fast__(x, y, z)
         now = time.time_ns()
-        if self.debug:
+        if now >= self.debug_next_print_time:
             print(f"[{event_count}] {(now - self.previous_event_time) / 1_000_000} ms x={x}, y={y}, z={z} {self.current}")
+            self.debug_next_print_time = now + DEBUG_PRINT_INTERVAL_NS
         self.previous_event_time = now
-        if event_count != 0:
-            self.hid_device.syn()
-        return
-
-
-class Smooth:
-    def __init__(self, n, alpha=0.1):
-        self.length = n
-        self.values = [0] * n
-        self.alpha = alpha
-        self.total = sum(self.values)
-
-    def smooth(self, v):
-        return self.smooth_lp_filter(v)
-
-    def smooth_simple(self, v):
-        # Simple moving average - very efficient
-        if self.length <= 1:
-            return v
-        self.total -= self.values[0]
-        self.values.pop(0)
-        self.values.append(v)
-        self.total += v
-        return self.total / self.length
-
-    def smooth_lp_filter(self, v):
-        # https://stackoverflow.com/questions/4611599/smoothing-data-from-a-sensor
-        # https://en.wikipedia.org/wiki/Low-pass_filter#Simple_infinite_impulse_response_filter
-        # The smaller the alpha, the more each previous value affects the following value.
-        # So a smaller alpha results in more smoothing.
-        # y[1] := alpha * x[1]
-        # for i from 2 to n
-        #     y[i] := y[i-1] + alpha * (x[i] - y[i-1])
-        if self.length <= 1:
-            return v
-        self.values.pop(0)
-        self.values.append(v)
-        smoothed = self.values[0] * self.alpha
-        for value in self.values[1:]:
-            smoothed = smoothed + self.alpha * (value - smoothed)
-        return smoothed
+        return event_count
+
+
+class SmoothAxes:
+    # Low-pass filter, see
+    # https://en.wikipedia.org/wiki/Low-pass_filter#Simple_infinite_impulse_response_filter
+    # The smaller the alpha, the more each previous value affects the following value.
+    # So a smaller alpha results in more smoothing.
+    # All the axes of a packet are stepped together, one call per packet rather than one per axis.
+    def __init__(self, n, alpha=0.1, width=6):
+        # Each axis may have its own alpha, an alpha of 1.0 passes the axis through unsmoothed.
+        alphas = alpha if isinstance(alpha, (list, tuple)) else [alpha] * width
+        self.alphas = [a if n > 1 else 1.0 for a in alphas]
+        self.y = [0.0] * width
+        self.smooth = self.smooth_first
+
+    def smooth_first(self, values):
+        # Start from the first real sample rather than ramping up from zero.
+        self.y = list(values)
+        self.smooth = self.smooth_lp_filter
+        return self.y
+
+    def smooth_lp_filter(self, values):
+        self.y = [y + a * (v - y) for y, a, v in zip(self.y, self.alphas, values)]
+        return self.y
+
+
+def receive_latest(sock, packet):
+    # Receive into the reusable packet buffer, then overwrite it with any backlog of
+    # queued packets, only the most recent head position matters.  Returns the latest
+    # packet unpacked into a tuple of 6 doubles, or None if none were complete.  A short
+    # datagram only partly overwrites the buffer, so it is dropped rather than unpacked.
+    latest = None
+    flags = 0
+    try:
+        while True:
+            if sock.recv_into(packet, 0, flags) == OPENTRACK_PACKET.size:
+                latest = OPENTRACK_PACKET.unpack_from(packet)
+            flags = socket.MSG_DONTWAIT
+    except BlockingIOError:
+        pass
+    return latest
+
+
+def set_realtime_priority(priority=REALTIME_PRIORITY):
+    # SCHED_FIFO keeps the desktop from delaying the 1 ms wait-for-input cycle.
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        print(f"Scheduling: SCHED_FIFO priority={priority}")
+    except PermissionError:
+        print(f"Scheduling: SCHED_FIFO priority={priority} refused, needs CAP_SYS_NICE or an rtprio limit "
+              f"(see /etc/security/limits.conf), continuing with normal scheduling.")
+
+
+def set_busy_poll(sock, usecs):
+    # Poll the network device while waiting, rather than sleeping until its interrupt arrives.
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL, usecs)
+        print(f"Busy-poll: {usecs} usecs")
+    except PermissionError:
+        print(f"Busy-poll: {usecs} usecs refused, needs CAP_NET_ADMIN for values above net.core.busy_read, "
+              f"continuing without busy-polling.")
+    except OSError as e:
+        print(f"Busy-poll: unavailable ({e}), continuing without busy-polling.")
+
+
+def set_cpu_affinity(cpu):
+    # Staying on one CPU avoids losing the warm cache to migrations between cores.
+    try:
+        os.sched_setaffinity(0, {cpu})
+        print(f"CPU affinity: {cpu}")
+    except OSError as e:
+        print(f"CPU affinity: unable to use CPU {cpu} ({e}), continuing unpinned.")
 
 
 def main():
-    if '-h' in sys.argv:
-        print(__doc__)
-        sys.exit(0)
+
     if '--make-md' in sys.argv:
         with open(Path(__file__).with_suffix('.md').name, 'w') as md:
             md.write(__doc__)
         sys.exit(0)
-    scale_factor = float(sys.argv[sys.argv.index('-f') + 1]) if '-f' in sys.argv else 35.0
-    wait_secs = float(sys.argv[sys.argv.index('-w') + 1]) if '-w' in sys.argv else 0.001
-    smooth_n = int(sys.argv[sys.argv.index('-s') + 1]) if '-s' in sys.argv else 100
-    smooth_alpha = float(sys.argv[sys.argv.index('-q') + 1]) if '-q' in sys.argv else 0.1
-    auto_center = float(sys.argv[sys.argv.index('-a') + 1]) if '-a' in sys.argv else 0.0
-    auto_center_secs = float(sys.argv[sys.argv.index('-t') + 1]) if '-t' in sys.argv else 1.0
-    mouse = OpenTrackMouse(scale_factor=scale_factor,
-                           wait_secs=wait_secs,
-                           auto_center=auto_center,
-                           auto_center_secs=auto_center_secs,
-                           smoothing=smooth_n,
-                           smooth_alpha=smooth_alpha,
-                           enable_wheel='-z' in sys.argv,
-                           debug='-d' in sys.argv)
-    udp_ip = sys.argv[sys.argv.index('-i') + 1] if '-i' in sys.argv else UDP_IP
-    udp_port = int(sys.argv[sys.argv.index('-p') + 1]) if '-p' in sys.argv else UDP_PORT
-    mouse.start(udp_ip=udp_ip, udp_port=udp_port)
+
+    parser = argparse.ArgumentParser(
+        prog="opentrack-mouse.py",
+        description="opentrack UDP-Output to Linux mouse events",
+        epilog="For example: opentrack-mouse.py -f 10 -a 8.0 -t 1.0 -z")
+    parser.add_argument('-H', '--detailed-help', default=False, action='store_true',
+                        help='detailed help (in Markdown format)')
+    parser.add_argument('-f', '--scale-factor', default=35.0, type=float,
+                        help="scale factor, alters sensitivity (10.0 is good for games)")
+    parser.add_argument('-w', '--wait-seconds', default=0.001, type=float,
+                        help="wait seconds for input, then interpolate")
+    parser.add_argument('-s', '--smooth-n', default=100, type=int,
+                        help="smoothing on for n > 1, off for n <= 1 (alpha sets the amount)")
+    parser.add_argument('-q', '--smooth-alpha', default=0.1, type=float,
+                        help="smoothing alpha 0.0..1.0, smaller values smooth more")
+    parser.add_argument('-a', '--auto-center', default=0.0, type=float,
+                        help="auto-center (press middle mouse button) if all tracking values are in the -zone..+zone")
+    parser.add_argument('-t', '--auto-center-seconds', default=1.0, type=float,
+                        help="auto-center required seconds for all values remain in the zone")
+    parser.add_argument('-z', '--wheel', default=False, action='store_true',
+                        help="translate opentrack z-axis values to mouse wheel events")
+    parser.add_argument('-i', '--ip-address', default=UDP_IP,
+                        help="the ip-address to listen on for the UDP feed from opentrack")
+    parser.add_argument('-p', '--port', default=UDP_PORT, type=int,
+                        help="the UDP port number to listen on for the UDP feed from opentrack")
+    parser.add_argument('-r', '--receive-buffer', default=UDP_RECEIVE_BUFFER, type=int,
+                        help="the UDP socket receive buffer size in bytes (limited by net.core.rmem_max)")
+    parser.add_argument('-P', '--busy-poll', default=0, type=int,
+                        help="busy-poll the network device for up to usecs when waiting for a packet (SO_BUSY_POLL)")
+    parser.add_argument('-R', '--realtime', default=False, action='store_true',
+                        help="use realtime scheduling (SCHED_FIFO) for more consistent timing")
+    parser.add_argument('-c', '--cpu', default=None, type=int,
+                        help="pin the process to the given CPU number")
+    parser.add_argument('-d', '--debug', default=False, action='store_true',
+                        help="output mouse event x, y, z values to stdout for debugging purposes")
+    args = parser.parse_args()
+    if args.detailed_help:
+        print(__doc__)
+        sys.exit(0)
+
+    mouse = OpenTrackMouse(scale_factor=args.scale_factor,
+                           wait_secs=args.wait_seconds,
+                           auto_center=args.auto_center,
+                           auto_center_secs=args.auto_center_seconds,
+                           smoothing=args.smooth_n,
+                           smooth_alpha=args.smooth_alpha,
+                           enable_wheel=args.wheel,
+                           debug=args.debug)
+    if args.realtime:
+        set_realtime_priority()
+    if args.cpu is not None:
+        set_cpu_affinity(args.cpu)
+    mouse.start(udp_ip=args.ip_address, udp_port=args.port, receive_buffer=args.receive_buffer,
+                busy_poll=args.busy_poll)
 
 
 if __name__ == '__main__':
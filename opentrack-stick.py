@@ -8,7 +8,7 @@ Translate opentrack UDP-output to Linux-HID joystick events.
 Usage:
 ======
 
-    python3 opentrack-stick.py [-h] [-s <int>] [-a <float>] [-b <int>{7}] [-i ip-addr] [-o <port>] [-d]
+    python3 opentrack-stick.py [-h] [-s <int>] [-a <float>] [-b <int>{7}] [-i ip-addr] [-o <port>] [-r <bytes>] [-P <usecs>] [-R] [-c <cpu>] [-d]
 
 Optional Arguments
 ------------------
@@ -16,8 +16,9 @@ Optional Arguments
     -w <float>, --wait-seconds <float>
                  Wait seconds for input, then interpolate (default 0.001
                  to simulate a 1000 MHz mouse)
-    -s <int>, --smooth <int>
-                 smooth over n values (default 250)
+    -s <int>, --smooth-n <int>
+                 smoothing is on for n greater than 1 and off for n of 1 or
+                 less, the amount of smoothing is set by alpha (default 250)
     -a <float>, --smooth-alpha <float>
                  smoothing alpha 0.0..1.0, smaller values smooth more (default 0.05)
     -b <int>{7}, --bind <int>{7}
@@ -28,10 +29,24 @@ Optional Arguments
                  the ip-address to listen on for the UDP feed from opentrack
     -p <port>, --port <port>
                  the UDP port number to listen on for the UDP feed from opentrack
+    -r <bytes>, --receive-buffer <bytes>
+                 the UDP socket receive buffer size, a larger buffer avoids dropping
+                 packets during scheduling delays, the kernel limits it to
+                 /proc/sys/net/core/rmem_max (default 1048576)
+    -P <usecs>, --busy-poll <usecs>
+                 busy-poll the network device for up to usecs when waiting
+                 for a packet (SO_BUSY_POLL), see Realtime Scheduling below
+                 (default 0, off)
+    -R, --realtime
+                 use realtime scheduling (SCHED_FIFO) for more consistent timing,
+                 see Realtime Scheduling below
+    -c <cpu>, --cpu <cpu>
+                 pin the process to the given CPU number (default unpinned)
     -h, --help   help
     -H, --detailed-help
                  detailed help (in Markdown format)
     -d           output joystick event values to stdout for debugging purposes
+                 (lines that would repeat for every packet are limited to 20 per second of each kind)
 
 Description
 ===========
@@ -243,6 +258,37 @@ To experiment with this possibility, I additionally mapped
 head zoom to axis 1, so I can optionally switch to the
 mapping `-b 9 10 1 4 5 0 12`.
 
+Realtime Scheduling
+===================
+
+The `-R` option requests the `SCHED_FIFO` realtime scheduling policy
+so that packets are handled promptly even when the desktop is busy.
+An unprivileged user needs a realtime-priority limit, for example,
+in `/etc/security/limits.conf`:
+
+    myuser  -  rtprio  20
+
+If the request is refused, a message is printed and opentrack-stick
+carries on with normal scheduling.
+
+The `-c <cpu>` option pins the process to a single CPU, which
+avoids it being migrated between cores.  Realtime scheduling and
+pinning work best together on a CPU that is otherwise lightly
+loaded, for example, one reserved by the `isolcpus=` kernel
+parameter.
+
+When opentrack runs on another machine, the `-P <usecs>` option
+asks the kernel to busy-poll the network device for up to usecs
+microseconds when waiting for a packet (`SO_BUSY_POLL`), rather than
+waiting for the device's interrupt.  This trades CPU time for lower
+and steadier latency.  It only helps devices with NAPI polling
+support, it has no effect on the loopback device used when opentrack
+runs on the same machine.  Values above `net.core.busy_read` need
+`CAP_NET_ADMIN`, if the request is refused, a message is printed and
+opentrack-stick carries on without busy-polling.  When busy-polling,
+pin the process with `-c` to a CPU that handles the network device's
+interrupts (see `/proc/irq/*/smp_affinity_list`).
+
 Opentrack Protocol
 ==================
 
@@ -317,8 +363,8 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import argparse
-import math
-import select
+import os
+import selectors
 import socket
 import struct
 import sys
@@ -331,9 +377,23 @@ from typing import Callable
 import evdev
 from evdev import AbsInfo
 from evdev import ecodes
+from evdev.ecodes import EV_ABS
 
 UDP_IP = "127.0.0.1"
 UDP_PORT = 5005
+UDP_RECEIVE_BUFFER = 1024 * 1024
+REALTIME_PRIORITY = 20
+# Debug lines are printed at most this often, a line per packet at 1 kHz is more than anyone can read.
+DEBUG_PRINT_INTERVAL_NS = 50_000_000
+# Linux socket option, not exported by the socket module.
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)
+
+# Each opentrack UDP-Output packet contains 6 little-endian doubles: x, y, z, yaw, pitch, and roll.
+OPENTRACK_PACKET = struct.Struct('<6d')
+
+# Linux struct input_event: struct timeval time, __u16 type, __u16 code, __s32 value.
+INPUT_EVENT = struct.Struct('@llHHi')
+SYN_REPORT_EVENT = INPUT_EVENT.pack(0, 0, ecodes.EV_SYN, ecodes.SYN_REPORT, 0)
 
 OpenTrackDataItem = namedtuple("OpenTrackDataItem", "name value min max")
 
@@ -347,6 +407,10 @@ class OpenTrackStick:
         self.debug = debug
         self.show_activity = False  # Summarises activity in one char outputs.
         self.start_time = time.time_ns()
+        self.debug_next_print_time = 0
+        self.debug_next_center_print_time = 0
+        # Pick the send implementation once, rather than testing for debug on every packet.
+        self.__send_to_hid__ = self.__send_to_hid_debug__ if debug else self.__send_to_hid_fast__
         self.smoothing = smoothing
         self.smooth_alpha = smooth_alpha
         self.activity_count = 0
@@ -361,18 +425,12 @@ class OpenTrackStick:
                                      OpenTrackDataItem('pitch', 0, -90, 90),
                                      OpenTrackDataItem('roll', 0, -90, 90)]
         self.abs_outputs_def_list = [
-            StickOutputDef(ecodes.ABS_RX, AbsInfo(value=0, min=-32767, max=32767, fuzz=16, flat=128, resolution=0),
-                           smoothing=smoothing, smooth_alpha=smooth_alpha),
-            StickOutputDef(ecodes.ABS_RY, AbsInfo(value=0, min=-32767, max=32767, fuzz=16, flat=128, resolution=0),
-                           smoothing=smoothing, smooth_alpha=smooth_alpha),
-            StickOutputDef(ecodes.ABS_RZ, AbsInfo(value=0, min=0, max=255, fuzz=0, flat=0, resolution=0),
-                           smoothing=smoothing, smooth_alpha=smooth_alpha, functional=False),
-            StickOutputDef(ecodes.ABS_X, AbsInfo(value=0, min=-32767, max=32767, fuzz=16, flat=128, resolution=0),
-                           smoothing=smoothing, smooth_alpha=smooth_alpha),
-            StickOutputDef(ecodes.ABS_Y, AbsInfo(value=0, min=-32767, max=32767, fuzz=16, flat=128, resolution=0),
-                           smoothing=smoothing, smooth_alpha=smooth_alpha),
-            StickOutputDef(ecodes.ABS_Z, AbsInfo(value=0, min=0, max=255, fuzz=0, flat=0, resolution=0),
-                           smoothing=smoothing, smooth_alpha=smooth_alpha, functional=False),
+            StickOutputDef(ecodes.ABS_RX, AbsInfo(value=0, min=-32767, max=32767, fuzz=16, flat=128, resolution=0)),
+            StickOutputDef(ecodes.ABS_RY, AbsInfo(value=0, min=-32767, max=32767, fuzz=16, flat=128, resolution=0)),
+            StickOutputDef(ecodes.ABS_RZ, AbsInfo(value=0, min=0, max=255, fuzz=0, flat=0, resolution=0), functional=False),
+            StickOutputDef(ecodes.ABS_X, AbsInfo(value=0, min=-32767, max=32767, fuzz=16, flat=128, resolution=0)),
+            StickOutputDef(ecodes.ABS_Y, AbsInfo(value=0, min=-32767, max=32767, fuzz=16, flat=128, resolution=0)),
+            StickOutputDef(ecodes.ABS_Z, AbsInfo(value=0, min=0, max=255, fuzz=0, flat=0, resolution=0), functional=False),
             HatOutputDef(ecodes.ABS_HAT0X, AbsInfo(value=0, min=-1, max=1, fuzz=0, flat=0, resolution=0)),
             HatOutputDef(ecodes.ABS_HAT0Y, AbsInfo(value=0, min=-1, max=1, fuzz=0, flat=0, resolution=0)), ]
         self.btn_output_def_list = [
@@ -401,7 +459,8 @@ class OpenTrackStick:
             ecodes.EV_ABS: [(output_def.evdev_code, output_def.evdev_abs_info) for output_def in self.abs_outputs_def_list],
             ecodes.EV_FF: [ecodes.FF_EFFECT_MIN, ecodes.FF_RUMBLE]
         }
-        self.hid_device = evdev.UInput(ui_input_capabilities, name="Microsoft X-Box 360 pad 0", vendor=0x0738, product=0x028F)
+        self.hid_device = UInputBatch(
+            evdev.UInput(ui_input_capabilities, name="Microsoft X-Box 360 pad 0", vendor=0x0738, product=0x028F))
         self.destination_list = []
         for destination_num, opentrack_cap in zip(bindings[0:6], self.opentrack_data_items):
             if destination_num == 0:
@@ -426,38 +485,91 @@ class OpenTrackStick:
                 dummy_destination_def = AcdTrainingDummyOutputDef(ecodes.BTN_A, ecodes.BTN_B)
                 dummy_destination_def.bind(self.opentrack_data_items[4])
                 self.destination_list[4] = dummy_destination_def
-
-    def start(self, udp_ip=UDP_IP, udp_port=UDP_PORT):
-        print(f"UDP IP={udp_ip} PORT={udp_port}")
+        # Only the bound axes need visiting for each packet, along with their index into the opentrack data.
+        self.bound_destinations = [(i, destination_def) for i, destination_def in enumerate(self.destination_list)
+                                   if destination_def is not None]
+        # The smoothing state for all six opentrack axes is held here.  Only the axes bound to stick outputs
+        # are smoothed, the others pass straight through (alpha 1.0).  Only the smoothed axes go on changing
+        # after the input stops, the others are always exhausted.
+        self.smoothed_axes = [i for i, destination_def in self.bound_destinations
+                              if isinstance(destination_def, StickOutputDef)]
+        self.smoother = SmoothAxes(n=smoothing, alpha=[smooth_alpha if i in self.smoothed_axes else 1.0
+                                                       for i in range(len(self.opentrack_data_items))])
+        # The stick outputs are a plain linear scaling, so they can all be cooked together in one pass,
+        # the hat and button outputs have their own rules and are cooked individually.
+        self.stick_codes = [destination_def.evdev_code for _, destination_def in self.bound_destinations
+                            if isinstance(destination_def, StickOutputDef)]
+        self.stick_scaling = [(i, destination_def.scale, destination_def.offset)
+                              for i, destination_def in self.bound_destinations
+                              if isinstance(destination_def, StickOutputDef)]
+        # The data is exhausted once every stick output is within its evdev fuzz of where the unsmoothed
+        # input would put it, so the smoothing has caught up with the input.  The extra half allows for the
+        # output being rounded, otherwise a target that falls half-way between two values is never reached.
+        self.stick_tolerance = [destination_def.evdev_abs_info.fuzz + 0.5
+                                for _, destination_def in self.bound_destinations
+                                if isinstance(destination_def, StickOutputDef)]
+        # Start from the values the device was created with, so only a change is ever written.
+        self.stick_values = [destination_def.evdev_abs_info.value for _, destination_def in self.bound_destinations
+                             if isinstance(destination_def, StickOutputDef)]
+        self.other_destinations = [(i, destination_def) for i, destination_def in self.bound_destinations
+                                   if not isinstance(destination_def, StickOutputDef)]
+        self.stick_destinations = [(i, destination_def) for i, destination_def in self.bound_destinations
+                                   if isinstance(destination_def, StickOutputDef)]
+        # What was sent for the last packet, for reporting by __send_to_hid_debug__.
+        self.other_values = [None] * len(self.other_destinations)
+        self.sent_any = False
+
+    def start(self, udp_ip=UDP_IP, udp_port=UDP_PORT, receive_buffer=UDP_RECEIVE_BUFFER, busy_poll=0):
+        print(f"UDP IP={udp_ip} PORT={udp_port} RCVBUF={receive_buffer}")
         print("\n*** CENTER CALIBRATION - PLEASE SIT STILL AND CENTERED (you have 5 seconds to get into position) ***")
         time.sleep(5.0)
         print("*** Waiting for reading from opentrack... ***")
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 48)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
         sock.bind((udp_ip, udp_port))
+        if busy_poll > 0:
+            set_busy_poll(sock, busy_poll)
+        # Register once, rather than having select() rebuild its fd sets on every iteration.
+        # A receive timeout (SO_RCVTIMEO) would save the wait call, but the kernel rounds it
+        # up to whole timer ticks (4 ms at CONFIG_HZ=250), far coarser than the 1 ms wait.
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        # Received into the same buffer every time, rather than allocating a new bytes per packet.
+        packet = bytearray(OPENTRACK_PACKET.size)
         data_exhausted = True
         current = (0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
         previous_send_time = 0
         min_send_nanos = int(1_000_000_000 * self.wait_secs / 2)
+        min_send_secs = min_send_nanos / 1_000_000_000.0
+        # The loop runs once per packet or wait, so look up everything it uses just the once.
+        wait_secs = self.wait_secs
+        show_activity = self.show_activity
+        print_activity = self.print_activity
+        select = selector.select
+        time_ns = time.time_ns
+        sleep = time.sleep
+        send_to_hid = self.__send_to_hid__
+        auto_center = self.__auto_center__
         while True:
-            self.print_activity("B" if data_exhausted else None) if self.show_activity else None
-            sock.setblocking(data_exhausted)
+            print_activity("B" if data_exhausted else None) if show_activity else None
             # Use previous data value if none is ready - keeps the mouse moving smoothly in the current direction
-            if data_exhausted or select.select([sock], [], [], self.wait_secs)[0]:
-                data, _ = sock.recvfrom(48)
-                self.print_activity("R") if self.show_activity else None
-                # Unpack 6 little endian doubles into a list:
-                current = struct.unpack('<6d', data[:48])
-                data_exhausted = False
+            if data_exhausted or select(wait_secs):
+                latest = receive_latest(sock, packet)
+                if latest is not None:
+                    print_activity("R") if show_activity else None
+                    current = latest
+                    data_exhausted = False
             # Stop and wait if the data has settled down and is not changing.
             # Note: smoothing will keep changing the data for a while even though input may have stopped arriving.
-            now = time.time_ns()
+            now = time_ns()
             if not data_exhausted:
                 if now - previous_send_time < min_send_nanos:
-                    self.print_activity(".") if self.show_activity else None
-                    time.sleep(min_send_nanos / 1_000_000_000.0)
-                data_exhausted = self.__send_to_hid__(current)
-                self.print_activity("+") if self.show_activity else None
+                    print_activity(".") if show_activity else None
+                    sleep(min_send_secs)
+                data_exhausted = send_to_hid(current)
+                # After the packet's syn, any auto-center button press goes out as events of its own.
+                auto_center(current)
+                print_activity("+") if show_activity else None
                 previous_send_time = now
             else:
                 if self.debug:
@@ -468,36 +580,68 @@ class OpenTrackStick:
             self.activity_count += 1
             print(indicator_char, end='\n' if self.activity_count % 100 == 0 else '')
 
+    def print_debug_throttled(self, message):
+        # For auto-center debug lines that would otherwise repeat for every packet.  They have a limit
+        # of their own, so they can't use up the slots of the stick value lines, or be crowded out by them.
+        now = time.time_ns()
+        if now >= self.debug_next_center_print_time:
+            print(message)
+            self.debug_next_center_print_time = now + DEBUG_PRINT_INTERVAL_NS
+
     def all_output_defs(self):
         return self.abs_outputs_def_list + self.btn_output_def_list
 
-    def __send_to_hid__(self, values):
-        global auto_center_needed
-        data_exhausted = True
-        send_t = time.time_ns() if self.debug else 0
-        sent_any = False
-        debug_msg = []
-        for i, destination_def, raw_value in zip(range(6), self.destination_list, values):
-            if destination_def:
-                cooked_value = destination_def.cooked_value(raw_value, self.center[i])
-                data_exhausted &= destination_def.data_exhausted
-                sent_any |= destination_def.send_to_hid(self.hid_device, cooked_value)
-                debug_msg.append(destination_def.debug_value(raw_value, cooked_value)) if self.debug and cooked_value is not None else None
-        if self.auto_center_training:
+    def __send_to_hid_fast__(self, values):
+        # Used when not debugging, nothing here is spent on timing or formatting messages.
+        hid_device = self.hid_device
+        center = self.center
+        sent_any = self.auto_center_training
+        # This may feed repeat data into the smoother, that should result in the latest value becoming stronger over time.
+        smoothed = self.smoother.smooth(values)
+        stick_values = [round(smoothed[i] * scale + offset) for i, scale, offset in self.stick_scaling]
+        # Only pass on the stick values that have changed, if none have, and nothing else is sent, the syn is skipped too.
+        changed = [(code, v) for code, v, p in zip(self.stick_codes, stick_values, self.stick_values) if v != p]
+        if changed:
+            hid_device.write_many(EV_ABS, changed)
             sent_any = True
+        # The hat and button values are kept for __send_to_hid_debug__, None where nothing was sent.
+        other_values = [destination_def.cooked_value(smoothed[i], center[i])
+                        for i, destination_def in self.other_destinations]
+        for (_, destination_def), cooked_value in zip(self.other_destinations, other_values):
+            sent_any |= destination_def.send_to_hid(hid_device, cooked_value)
+        data_exhausted = all([-tolerance <= values[i] * scale + offset - v <= tolerance
+                              for (i, scale, offset), v, tolerance in zip(self.stick_scaling, stick_values,
+                                                                          self.stick_tolerance)])
+        self.stick_values = stick_values
+        self.other_values = other_values
+        self.sent_any = sent_any
         if sent_any:
-            self.hid_device.syn()
-            now = time.time_ns()
-            if self.__auto_center__(values):
-                pass
-                # debug_msg.append(self.auto_center_destination.debug_value(0.0, 1)) if self.debug else None
-            if self.debug:
-                messages = ", ".join(debug_msg)
-                if messages != '':
-                    print(f"@{(now - self.start_time) / 1_000_000_000:.3f} sec, {(now - send_t) / 1_000_000:.2f} ms,"
-                          f"data_exhausted={data_exhausted}",
-                          messages)
+            hid_device.syn()
+        return data_exhausted
 
+    def __send_to_hid_debug__(self, values):
+        # Sends exactly as __send_to_hid_fast__ does, then reports what it sent.
+        send_t = time.time_ns()
+        # Only spend time formatting the stick values when a line of them is due to be printed.
+        show = send_t >= self.debug_next_print_time
+        data_exhausted = self.__send_to_hid_fast__(values)
+        if self.sent_any:
+            now = time.time_ns()
+            debug_msg = []
+            if show:
+                debug_msg += [destination_def.debug_value(values[i], cooked_value)
+                              for (i, destination_def), cooked_value in zip(self.stick_destinations, self.stick_values)]
+            # Hat and button events are occasional, and needed when mapping controls, always show them.
+            debug_msg += [destination_def.debug_value(values[i], cooked_value)
+                          for (i, destination_def), cooked_value in zip(self.other_destinations, self.other_values)
+                          if cooked_value is not None]
+            messages = ", ".join(debug_msg)
+            if messages != '':
+                print(f"@{(now - self.start_time) / 1_000_000_000:.3f} sec, {(now - send_t) / 1_000_000:.2f} ms,"
+                      f"data_exhausted={data_exhausted}",
+                      messages)
+                if show:
+                    self.debug_next_print_time = now + DEBUG_PRINT_INTERVAL_NS
         return data_exhausted
 
     def __auto_center__(self, values):
@@ -515,7 +659,7 @@ class OpenTrackStick:
         if auto_center_needed:
             for i, center_value, value in zip(range(6), self.center, values):  # Ignore z - forward backward offset
                 if abs(center_value - value) > 15.0:
-                    print(f"Off center {time.strftime('%H:%M:%S')}") if self.debug else False
+                    self.print_debug_throttled(f"Off center {time.strftime('%H:%M:%S')}") if self.debug else False
                     return False
             self.auto_center_destination.reset()
             self.auto_center_destination.send_to_hid(self.hid_device, 1)
@@ -528,13 +672,36 @@ class OpenTrackStick:
         return False
 
 
+class UInputBatch:
+    # Stands in for evdev.UInput, but holds back the events written for a packet and
+    # passes them all to uinput in a single writev() when syn() is called.  The kernel
+    # accepts any number of input_event structs per write, which saves a system call
+    # per axis.  The kernel time-stamps injected events itself, so the time is left zero.
+    def __init__(self, uinput):
+        self.uinput = uinput
+        self.fd = uinput.fd
+        self.events = []
+
+    def write(self, evdev_type, evdev_code, value):
+        self.events.append(INPUT_EVENT.pack(0, 0, evdev_type, evdev_code, value))
+
+    def write_many(self, evdev_type, code_values):
+        # Queue an event for each (code, value) pair in one pass, rather than a write() call per event.
+        pack = INPUT_EVENT.pack
+        self.events.extend([pack(0, 0, evdev_type, evdev_code, value) for evdev_code, value in code_values])
+
+    def syn(self):
+        self.events.append(SYN_REPORT_EVENT)
+        os.writev(self.fd, self.events)
+        self.events.clear()
+
+
 class OutputDef:
     def __init__(self, evdev_type, evdev_code, evdev_name, functional=True):
         self.evdev_type = evdev_type
         self.evdev_code = evdev_code
         self.opentrack_info = None
         self.name = str(evdev_name).replace("'", "").replace(' ', '')
-        self.data_exhausted = True
         self.functional = functional
 
     def bind(self, opentrack_info):
@@ -558,23 +725,25 @@ class OutputDef:
 
 class StickOutputDef(OutputDef):
 
-    def __init__(self, evdev_code, evdev_abs_info, smoothing=500, smooth_alpha=0.1, output_plot_data=False, functional=True):
+    def __init__(self, evdev_code, evdev_abs_info, output_plot_data=False, functional=True):
         super().__init__(ecodes.EV_ABS, evdev_code, ecodes.ABS[evdev_code], functional)
         self.evdev_abs_info = evdev_abs_info
-        self.previous_smoothed_value = 0.0
-        self.smoother = Smooth(n=smoothing, alpha=smooth_alpha)
         self.output_plot_data = output_plot_data
+        self.scale = 1.0
+        self.offset = 0.0
 
-    def cooked_value(self, raw_value, center_value):
+    def bind(self, opentrack_info):
+        super().bind(opentrack_info)
+        # The opentrack to evdev range mapping is fixed once bound, reduce it to a multiply-add.
         ev_info = self.evdev_abs_info
-        ot_info = self.opentrack_info
-        # This may feed repeat data into the smoother, that should result in the latest value becoming stronger over time.
-        smoothed = self.smoother.smooth(raw_value)
-        self.data_exhausted = math.isclose(smoothed, self.previous_smoothed_value, abs_tol=0.1)
-        self.previous_smoothed_value = smoothed
-        cooked = ev_info.min + round(((smoothed - ot_info.min) / (ot_info.max - ot_info.min)) * (ev_info.max - ev_info.min))
+        self.scale = (ev_info.max - ev_info.min) / (opentrack_info.max - opentrack_info.min)
+        self.offset = ev_info.min - opentrack_info.min * self.scale
+
+    def cooked_value(self, smoothed_value, center_value):
+        # The value arrives already smoothed by OpenTrackStick.
+        cooked = round(smoothed_value * self.scale + self.offset)
         if self.output_plot_data:
-            print("EVENT_DATA", self.name, raw_value, smoothed, cooked)
+            print("EVENT_DATA", self.name, smoothed_value, cooked)
         return cooked
 
     def send_to_hid(self, hid_device, cooked_value):
@@ -591,7 +760,7 @@ class HatOutputDef(OutputDef):
 
     def cooked_value(self, raw_value, center_value):
         dif = round(raw_value - center_value)
-        cooked_value = 0 if -15 < dif < 15 else (dif // abs(dif))
+        cooked_value = 0 if -15 < dif < 15 else (1 if dif > 0 else -1)
         if cooked_value == self.previous_cooked_value:
             # Don't send again until the key value changes to a different value (-1/0/1)
             return None
@@ -617,7 +786,7 @@ class BtnPairOutputDef(OutputDef):
 
     def cooked_value(self, raw_value, center_value):
         dif = round(raw_value - center_value)
-        direction = 0 if -15 < dif < 15 else (dif // abs(dif))
+        direction = 0 if -15 < dif < 15 else (1 if dif > 0 else -1)
         if direction != 0:
             # It's button down, then the button may have changed, which button was it?
             self.evdev_code = self.evdev_code_plus if direction > 0 else self.evdev_code_minus
@@ -662,42 +831,76 @@ class AcdTrainingDummyOutputDef(BtnPairOutputDef):
         return ''
 
 
-class Smooth:
-    def __init__(self, n, alpha=0.1):
-        self.length = n
-        self.values = [0] * n
-        self.alpha = alpha
-        self.total = sum(self.values)
-
-    def smooth(self, v):
-        return self.smooth_lp_filter(v)
-
-    def smooth_simple(self, v):
-        # Simple moving average - very efficient
-        if self.length <= 1:
-            return v
-        self.total -= self.values[0]
-        self.values.pop(0)
-        self.values.append(v)
-        self.total += v
-        return self.total / self.length
-
-    def smooth_lp_filter(self, v):
-        # https://stackoverflow.com/questions/4611599/smoothing-data-from-a-sensor
-        # https://en.wikipedia.org/wiki/Low-pass_filter#Simple_infinite_impulse_response_filter
-        # The smaller the alpha, the more each previous value affects the following value.
-        # So a smaller alpha results in more smoothing.
-        # y[1] := alpha * x[1]
-        # for i from 2 to n
-        #     y[i] := y[i-1] + alpha * (x[i] - y[i-1])
-        if self.length <= 1:
-            return v
-        self.values.pop(0)
-        self.values.append(v)
-        smoothed = self.values[0] * self.alpha
-        for value in self.values[1:]:
-            smoothed = smoothed + self.alpha * (value - smoothed)
-        return smoothed
+class SmoothAxes:
+    # Low-pass filter, see
+    # https://en.wikipedia.org/wiki/Low-pass_filter#Simple_infinite_impulse_response_filter
+    # The smaller the alpha, the more each previous value affects the following value.
+    # So a smaller alpha results in more smoothing.
+    # All the axes of a packet are stepped together, one call per packet rather than one per axis.
+    def __init__(self, n, alpha=0.1, width=6):
+        # Each axis may have its own alpha, an alpha of 1.0 passes the axis through unsmoothed.
+        alphas = alpha if isinstance(alpha, (list, tuple)) else [alpha] * width
+        self.alphas = [a if n > 1 else 1.0 for a in alphas]
+        self.y = [0.0] * width
+        self.smooth = self.smooth_first
+
+    def smooth_first(self, values):
+        # Start from the first real sample rather than ramping up from zero.
+        self.y = list(values)
+        self.smooth = self.smooth_lp_filter
+        return self.y
+
+    def smooth_lp_filter(self, values):
+        self.y = [y + a * (v - y) for y, a, v in zip(self.y, self.alphas, values)]
+        return self.y
+
+
+def receive_latest(sock, packet):
+    # Receive into the reusable packet buffer, then overwrite it with any backlog of
+    # queued packets, only the most recent head position matters.  Returns the latest
+    # packet unpacked into a tuple of 6 doubles, or None if none were complete.  A short
+    # datagram only partly overwrites the buffer, so it is dropped rather than unpacked.
+    latest = None
+    flags = 0
+    try:
+        while True:
+            if sock.recv_into(packet, 0, flags) == OPENTRACK_PACKET.size:
+                latest = OPENTRACK_PACKET.unpack_from(packet)
+            flags = socket.MSG_DONTWAIT
+    except BlockingIOError:
+        pass
+    return latest
+
+
+def set_realtime_priority(priority=REALTIME_PRIORITY):
+    # SCHED_FIFO keeps the desktop from delaying the 1 ms wait-for-input cycle.
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        print(f"Scheduling: SCHED_FIFO priority={priority}")
+    except PermissionError:
+        print(f"Scheduling: SCHED_FIFO priority={priority} refused, needs CAP_SYS_NICE or an rtprio limit "
+              f"(see /etc/security/limits.conf), continuing with normal scheduling.")
+
+
+def set_busy_poll(sock, usecs):
+    # Poll the network device while waiting, rather than sleeping until its interrupt arrives.
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL, usecs)
+        print(f"Busy-poll: {usecs} usecs")
+    except PermissionError:
+        print(f"Busy-poll: {usecs} usecs refused, needs CAP_NET_ADMIN for values above net.core.busy_read, "
+              f"continuing without busy-polling.")
+    except OSError as e:
+        print(f"Busy-poll: unavailable ({e}), continuing without busy-polling.")
+
+
+def set_cpu_affinity(cpu):
+    # Staying on one CPU avoids losing the warm cache to migrations between cores.
+    try:
+        os.sched_setaffinity(0, {cpu})
+        print(f"CPU affinity: {cpu}")
+    except OSError as e:
+        print(f"CPU affinity: unable to use CPU {cpu} ({e}), continuing unpinned.")
 
 
 def main():
@@ -724,13 +927,21 @@ def main():
     parser.add_argument('-w', '--wait-seconds', default=0.001, type=float,
                         help="wait seconds for input, then interpolate")
     parser.add_argument('-s', '--smooth-n', default=250, type=int,
-                        help="smooth over n values")
+                        help="smoothing on for n > 1, off for n <= 1 (alpha sets the amount)")
     parser.add_argument('-a', '--smooth-alpha', default=0.05, type=float,
                         help="smoothing alpha 0.0..1.0, smaller values smooth more")
     parser.add_argument('-i', '--ip-address', default=UDP_IP,
                         help="the ip-address to listen on for the UDP feed from opentrack")
     parser.add_argument('-p', '--port', default=UDP_PORT, type=int,
                         help="the UDP port number to listen on for the UDP feed from opentrack")
+    parser.add_argument('-r', '--receive-buffer', default=UDP_RECEIVE_BUFFER, type=int,
+                        help="the UDP socket receive buffer size in bytes (limited by net.core.rmem_max)")
+    parser.add_argument('-P', '--busy-poll', default=0, type=int,
+                        help="busy-poll the network device for up to usecs when waiting for a packet (SO_BUSY_POLL)")
+    parser.add_argument('-R', '--realtime', default=False, action='store_true',
+                        help="use realtime scheduling (SCHED_FIFO) for more consistent timing")
+    parser.add_argument('-c', '--cpu', default=None, type=int,
+                        help="pin the process to the given CPU number")
     parser.add_argument('-d', '--debug', default=False, action='store_true',
                         help="output joystick event values to stdout for debugging purposes")
     args = parser.parse_args()
@@ -743,9 +954,14 @@ def main():
                            smooth_alpha=args.smooth_alpha,
                            bindings=args.bind,
                            debug=args.debug)
+    if args.realtime:
+        set_realtime_priority()
+    if args.cpu is not None:
+        set_cpu_affinity(args.cpu)
     udp_ip = args.ip_address
     udp_port = args.port
-    stick.start(udp_ip=udp_ip, udp_port=udp_port)
+    stick.start(udp_ip=udp_ip, udp_port=udp_port, receive_buffer=args.receive_buffer,
+                busy_poll=args.busy_poll)
 
 
 if __name__ == '__main__':